@@ -1,6 +1,8 @@
 import os
 import io
 import warnings
+import queue
+import concurrent.futures
 from PIL import Image
 from stability_sdk import client
 import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
@@ -14,7 +16,7 @@ try:
     
     stability_api = client.StabilityInference(
         key=api_key,
-        verbose=True,
+        verbose=False,
         engine="stable-diffusion-xl-1024-v1-0",
     )
     print("Successfully connected to Stability AI API.")
@@ -58,29 +60,48 @@ answers = stability_api.generate(
 )
 
 # --- Process and Save the Image ---
-# (The saving part of the code remains the same, just make sure to use the new output_filename)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def _save_artifact(binary, filename):
+    if binary.startswith(PNG_SIGNATURE):
+        # Already a PNG, so write the bytes as-is instead of decoding and re-encoding
+        with open(filename, "wb") as f:
+            f.write(binary)
+    else:
+        Image.open(io.BytesIO(binary)).save(filename)
+    return filename
+
 image_saved = False
 safety_filter_activated = False
 last_artifact_type_info = "No specific artifact processed." 
+pending_saves = queue.Queue()
 
-for resp in answers:
-    for artifact in resp.artifacts:
-        last_artifact_type_info = f"Artifact type: {artifact.type}, Finish reason: {artifact.finish_reason}"
-        if artifact.finish_reason == generation.FILTER:
-            warnings.warn(
-                "Your request activated the API's safety filter and could not be processed. "
-                "Please modify the prompt and try again.")
-            print("Safety filter activated. No image generated.")
-            safety_filter_activated = True
-            break 
-        elif artifact.type == generation.ARTIFACT_IMAGE:
-            img = Image.open(io.BytesIO(artifact.binary))
-            img.save(output_filename) # Use the new filename
-            print(f"Image successfully saved as {output_filename}")
-            image_saved = True
+# Save each image on a worker thread while the main thread keeps
+# receiving the rest of the stream (matters when samples > 1).
+with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+    image_count = 0
+    for resp in answers:
+        for artifact in resp.artifacts:
+            last_artifact_type_info = f"Artifact type: {artifact.type}, Finish reason: {artifact.finish_reason}"
+            if artifact.finish_reason == generation.FILTER:
+                warnings.warn(
+                    "Your request activated the API's safety filter and could not be processed. "
+                    "Please modify the prompt and try again.")
+                print("Safety filter activated. No image generated.")
+                safety_filter_activated = True
+                break 
+            elif artifact.type == generation.ARTIFACT_IMAGE:
+                # First image keeps the chosen name, extra samples get a numeric suffix
+                name, ext = os.path.splitext(output_filename)
+                filename = output_filename if image_count == 0 else f"{name}_{image_count}{ext}"
+                pending_saves.put(pool.submit(_save_artifact, artifact.binary, filename))
+                image_count += 1
+        if safety_filter_activated:
             break
-    if image_saved or safety_filter_activated:
-        break
+
+    while not pending_saves.empty():
+        print(f"Image successfully saved as {pending_saves.get().result()}")
+        image_saved = True
 
 if not image_saved and not safety_filter_activated:
     print(f"No image artifact found in the response. Last artifact info: {last_artifact_type_info}")
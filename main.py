@@ -1,132 +1,395 @@
 import os
 import io
+import asyncio
 import warnings
-import uuid # For generating unique filenames
+import time
+import random
+import itertools
+import logging
+import logging.handlers
+import queue
+import functools
+from enum import Enum
+import hashlib
+import json
+import aiofiles
+import aiofiles.os
+import grpc
 from fastapi import FastAPI
+from fastapi.responses import Response
+from pydantic import BaseModel
 from PIL import Image
-from stability_sdk import client
 import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
+import stability_sdk.interfaces.gooseai.generation.generation_pb2_grpc as generation_grpc
+
+# --- Event Loop ---
+# Uvicorn creates the event loop before importing this module, so the loop is
+# chosen on the command line. Its default (--loop auto) already uses uvloop
+# when it's installed; to require it explicitly:
+#   uvicorn main:app --loop uvloop --http httptools --workers 4
 
 # --- FastAPI App Setup ---
 app = FastAPI()
 
+# --- Logging ---
+# Handlers only push records onto a queue; a background thread does the
+# actual writing so requests never wait on stdout.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+
 # --- Stability AI Configuration ---
 # Ensure STABILITY_KEY is set in the environment where Uvicorn runs
 os.environ['STABILITY_HOST'] = 'grpc.stability.ai:443' 
-stability_api = None # We will initialize this when the app starts
+ENGINE_ID = "stable-diffusion-xl-1024-v1-0"
+SAMPLES = 1 # Images generated per request
+POOL_SIZE = 4 # Number of separate connections to spread concurrent requests over
+stability_pool = [] # Async gRPC stubs, filled when the app starts
+_channels = [] # Channels behind stability_pool, closed on shutdown
+_next_stub = None # Round-robin iterator over stability_pool
+_background_tasks = set() # Keeps pending generations and disk writes alive until they finish
+CACHE_DIR = "image_cache" # Previously generated images, keyed by request parameters
+_inflight = {} # Cache path -> task for the generation currently running for it
+OUTPUT_DIR = "out" # Generated images, spread over subdirectories
+_filename_counter = itertools.count() # Per-process sequence for unique filenames
+
+# Keep the connection alive between requests so idle periods don't tear it
+# down, and size the buffers for multi-megabyte PNG artifacts so receiving
+# them doesn't stall on HTTP/2 flow control.
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_receive_message_length", 64 * 1024 * 1024),
+    ("grpc.http2.lookahead_bytes", 2 * 1024 * 1024),
+    ("grpc.per_rpc_retry_buffer_size", 4 * 1024 * 1024),
+]
+
+# --- Helper: Open a warmed-up gRPC channel ---
+# Uses the asyncio gRPC API so calls run on the event loop without a thread
+# per in-flight request.
+async def _open_channel(api_key, user_agent):
+    credentials = grpc.composite_channel_credentials(
+        grpc.ssl_channel_credentials(),
+        grpc.access_token_call_credentials(api_key), # Sends "authorization: Bearer <key>"
+    )
+    # gRPC shares connections between channels with identical arguments, so a
+    # distinct user agent gives each pooled channel its own connection.
+    options = GRPC_CHANNEL_OPTIONS + [("grpc.primary_user_agent", user_agent)]
+    # PNGs are already compressed, so compressing messages would only cost CPU
+    channel = grpc.aio.secure_channel(
+        os.environ['STABILITY_HOST'], credentials, options=options, compression=grpc.Compression.NoCompression
+    )
+    _channels.append(channel)
+    # Do the DNS lookup, TLS handshake and HTTP/2 setup now, not on the first request
+    await asyncio.wait_for(channel.channel_ready(), timeout=10)
+    return channel
 
 # --- Helper: Initialize Stability API ---
 # This function will run once when FastAPI starts up
 @app.on_event("startup")
 async def startup_event():
-    global stability_api
+    global stability_pool, _next_stub
+    _log_listener.start()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # Without a working connection no request can succeed, so refuse to start
+    # instead of serving errors.
     api_key = os.environ.get('STABILITY_KEY')
     if not api_key:
-        print("FATAL ERROR: STABILITY_KEY environment variable not set.")
-        print("Please set STABILITY_KEY before running the Uvicorn server.")
-        # In a real app, you might want to prevent startup or handle this more gracefully
-        # For now, we'll let it proceed, but image generation will fail.
-        return 
-        
-    try:
-        stability_api = client.StabilityInference(
-            key=api_key,
-            verbose=True,
-            engine="stable-diffusion-xl-1024-v1-0",
-        )
-        print("Successfully connected to Stability AI API on startup.")
-    except Exception as e:
-        print(f"Error connecting to Stability AI on startup: {e}")
-        stability_api = None # Ensure it's None if connection failed
+        logger.error("FATAL ERROR: STABILITY_KEY environment variable not set.")
+        logger.error("Please set STABILITY_KEY before running the Uvicorn server.")
+        _log_listener.stop() # Shutdown hooks don't run if startup fails, so flush logs here
+        raise RuntimeError("STABILITY_KEY environment variable not set.")
+
+    # Let every open finish so no channel is left half-open when one fails
+    channels = await asyncio.gather(
+        *(_open_channel(api_key, f"pool-{i}") for i in range(POOL_SIZE)), return_exceptions=True
+    )
+    errors = [result for result in channels if isinstance(result, BaseException)]
+    if errors:
+        e = errors[0]
+        logger.error(f"Error connecting to Stability AI on startup: {e}")
+        # Shutdown hooks won't run, so close the channels that were opened here
+        for channel in _channels:
+            await channel.close(grace=None)
+        _channels.clear()
+        _log_listener.stop()
+        raise RuntimeError(f"Could not connect to Stability AI: {e}") from e
+    stability_pool = [generation_grpc.GenerationServiceStub(channel) for channel in channels]
+    _next_stub = itertools.cycle(stability_pool)
+    logger.info(f"Successfully connected to Stability AI API on startup ({POOL_SIZE} connections).")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for channel in _channels:
+        await channel.close(grace=None)
+    _log_listener.stop() # Flushes any queued log records
 
 # --- Aspect Ratio Definitions ---
+# The enum values are what clients send; validation happens while the request
+# body is parsed, so the endpoint can look up the dimensions directly.
+class AspectRatio(str, Enum):
+    SQUARE = "1:1_square"
+    WIDESCREEN = "16:9_widescreen"
+    TALL = "9:16_tall"
+    LANDSCAPE = "3:2_landscape"
+    PORTRAIT = "2:3_portrait"
+
 ASPECT_RATIOS = {
-    "1:1_square": (1024, 1024),
-    "16:9_widescreen": (1344, 768),
-    "9:16_tall": (768, 1344),
-    "3:2_landscape": (1216, 832),
-    "2:3_portrait": (832, 1216),
+    AspectRatio.SQUARE: (1024, 1024),
+    AspectRatio.WIDESCREEN: (1344, 768),
+    AspectRatio.TALL: (768, 1344),
+    AspectRatio.LANDSCAPE: (1216, 832),
+    AspectRatio.PORTRAIT: (832, 1216),
+}
+
+# --- Prompt Messages ---
+# Building protobuf messages is relatively slow in Python, so the weight
+# parameters are shared and the prompt lists for repeated inputs are cached.
+_POS_PARAMS = generation.PromptParameters(weight=1.0)
+_NEG_PARAMS = generation.PromptParameters(weight=-1.0)
+
+@functools.lru_cache(maxsize=128)
+def _build_prompts(prompt, negative_prompt):
+    prompts = (generation.Prompt(text=prompt, parameters=_POS_PARAMS),)
+    if negative_prompt:
+        prompts += (generation.Prompt(text=negative_prompt, parameters=_NEG_PARAMS),)
+    return prompts
+
+# --- Request Templates ---
+# One ready-made request per aspect ratio with all generation settings filled
+# in; each request copies its template and only adds the prompts.
+def _build_request_template(width, height):
+    return generation.Request(
+        engine_id=ENGINE_ID,
+        image=generation.ImageParameters(
+            width=width,
+            height=height,
+            samples=SAMPLES,
+            steps=50,
+            transform=generation.TransformType(diffusion=generation.SAMPLER_K_DPMPP_2M),
+            parameters=[
+                generation.StepParameter(
+                    scaled_step=0,
+                    sampler=generation.SamplerParameters(cfg_scale=7.0),
+                )
+            ],
+        ),
+    )
+
+_REQUEST_TEMPLATES = {
+    key: _build_request_template(width, height)
+    for key, (width, height) in ASPECT_RATIOS.items()
 }
 
+# --- Helper: Artifact Stream ---
+async def _iter_artifacts(stub, prompt, negative_prompt, aspect_ratio_key):
+    request = generation.Request()
+    request.CopyFrom(_REQUEST_TEMPLATES[aspect_ratio_key])
+    request.prompt.extend(_build_prompts(prompt, negative_prompt))
+    # Random seed per request, like the SDK's generate() does when none is given
+    request.image.seed.append(random.randrange(0, 4294967295))
+    answers = stub.Generate(request, wait_for_ready=True)
+
+    try:
+        async for resp in answers:
+            for artifact in resp.artifacts:
+                yield artifact
+    finally:
+        # If we stop early, cancel the call so gRPC stops buffering the rest of
+        # the stream and frees the connection's flow-control window.
+        answers.cancel()
+
+# --- Helper: PNG Output ---
+# Artifacts normally arrive PNG-encoded and are passed through untouched; PIL
+# is only used if the API ever sends another format.
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def _reencode_png(binary):
+    output = io.BytesIO()
+    Image.open(io.BytesIO(binary)).save(output, format="PNG")
+    return output.getvalue()
+
+async def _ensure_png(binary):
+    if binary.startswith(PNG_SIGNATURE):
+        return binary
+    # Decoding and re-encoding blocks, so keep it off the event loop
+    return await asyncio.to_thread(_reencode_png, binary)
+
+# --- Helper: Multipart Response ---
+# Each image is sent as its own part of a multipart response.
+MULTIPART_BOUNDARY = "frame"
+
+def _multipart_frame(image_bytes):
+    header = (
+        f"--{MULTIPART_BOUNDARY}\r\n"
+        f"Content-Type: image/png\r\n"
+        f"Content-Length: {len(image_bytes)}\r\n\r\n"
+    ).encode()
+    return header + image_bytes + b"\r\n"
+
+MULTIPART_MEDIA_TYPE = f"multipart/x-mixed-replace; boundary={MULTIPART_BOUNDARY}"
+
+def _images_response(images, filename):
+    return Response(
+        content=b"".join(_multipart_frame(image) for image in images),
+        media_type=MULTIPART_MEDIA_TYPE,
+        headers={"Content-Disposition": f'inline; filename="{filename}"'},
+    )
+
+# --- Helper: Image Cache ---
+# Identical requests get the same key, so repeats are served from disk
+# without calling the API again.
+def _cache_path(prompt, negative_prompt, aspect_ratio_key):
+    # JSON keeps the fields apart, so e.g. ("a|b", "c") and ("a", "b|c") don't collide
+    fields = json.dumps([prompt, negative_prompt, aspect_ratio_key.value])
+    key = hashlib.blake2b(fields.encode(), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.png")
+
+# --- Helper: Output Filenames ---
+# A process-local counter plus the PID keeps names unique across workers
+# without reading random bytes for every request. Files are spread over 256
+# subdirectories so no single directory grows without bound.
+@functools.lru_cache(maxsize=None)
+def _output_dir(shard):
+    path = os.path.join(OUTPUT_DIR, shard)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _new_output_filename():
+    seq = next(_filename_counter)
+    unique_id = f"{os.getpid()}-{seq:010x}-{time.time_ns():x}"
+    return os.path.join(_output_dir(f"{seq % 256:02x}"), f"generated_image_{unique_id}.png")
+
+# --- Helper: Save Image Without Blocking the Response ---
+async def _save_image(image_bytes, filename, cache_path):
+    try:
+        async with aiofiles.open(filename, "wb") as f:
+            await f.write(image_bytes)
+        logger.info(f"Image successfully saved as {filename}")
+    except Exception as e:
+        logger.error(f"Error saving image {filename}: {e}")
+        return
+    try:
+        await aiofiles.os.link(filename, cache_path)
+    except FileExistsError:
+        pass # A concurrent identical request already cached it
+    except Exception as e:
+        logger.error(f"Error caching image {filename}: {e}")
+
+# --- Helper: Shared Generation ---
+# Runs as its own task, held in _inflight, so identical requests share one
+# paid generation and a client disconnecting doesn't cancel it for the rest.
+async def _generate(stub, prompt, negative_prompt, aspect_ratio_key, output_filename, cache_path):
+    saving = False
+    try:
+        images = []
+        filtered = False
+        artifacts = _iter_artifacts(stub, prompt, negative_prompt, aspect_ratio_key)
+        try:
+            async for artifact in artifacts:
+                if artifact.finish_reason == generation.FILTER:
+                    filtered = True
+                    continue
+                if artifact.type == generation.ARTIFACT_IMAGE:
+                    images.append(await _ensure_png(artifact.binary))
+                    if len(images) == SAMPLES:
+                        break
+        except Exception as e:
+            logger.error(f"Error during image generation: {e}")
+            if not images:
+                return {"error": "Failed to generate image.", "details": str(e)}
+        finally:
+            # Cancels the call once we have every requested image
+            await artifacts.aclose()
+
+        if not images:
+            if filtered:
+                warnings.warn("Request activated the API's safety filter.")
+                return {"error": "Safety filter activated. Please modify prompt.", "details": "Could not generate or save image."}
+            return {"error": "No image generated.", "details": "Could not generate or save image."}
+
+        save_task = asyncio.create_task(_save_image(images[0], output_filename, cache_path))
+        _background_tasks.add(save_task)
+        save_task.add_done_callback(_background_tasks.discard)
+        # Identical requests keep joining this one until the image is in the
+        # cache, so none of them starts a second generation.
+        save_task.add_done_callback(lambda _: _inflight.pop(cache_path, None))
+        saving = True
+        return images
+    finally:
+        if not saving:
+            _inflight.pop(cache_path, None)
+
+# --- Request Body ---
+# Sent as JSON instead of query parameters: long prompts don't run into URL
+# length limits, and the aspect ratio is validated while parsing the body.
+class GenerateRequest(BaseModel):
+    prompt: str
+    negative_prompt: str = "" # Optional, defaults to empty string
+    aspect_ratio_key: AspectRatio = AspectRatio.SQUARE # Optional, defaults to square
+
+# --- Response Bodies ---
+# Declared as response models so FastAPI serializes them with Pydantic's
+# compiled serializer instead of the generic JSON encoder.
+class MessageResponse(BaseModel):
+    message: str
+
+class ErrorResponse(BaseModel):
+    error: str
+    details: str
+
 # --- API Endpoints ---
-@app.get("/")
+@app.get("/", response_model=MessageResponse)
 async def read_root():
     return {"message": "Welcome to the AI Image Generator API!"}
 
-@app.post("/generate-image/") # Changed to POST, more appropriate for actions
-async def generate_image_endpoint(
-    prompt: str, 
-    negative_prompt: str = "",  # Optional, defaults to empty string
-    aspect_ratio_key: str = "1:1_square" # Optional, defaults to square
-):
-    if stability_api is None:
-        api_key_status = "NOT SET or connection FAILED" if not os.environ.get('STABILITY_KEY') else "Set, but connection FAILED on startup"
-        return {
-            "error": "Stability API not initialized. Check server logs.",
-            "detail": f"STABILITY_KEY status: {api_key_status}. Please ensure it's set correctly when starting Uvicorn."
-        }
-
-    if aspect_ratio_key not in ASPECT_RATIOS:
-        return {"error": "Invalid aspect_ratio_key", "available_keys": list(ASPECT_RATIOS.keys())}
+# Images are returned as a Response and skip the model; only errors are JSON
+@app.post("/generate-image/", response_model=ErrorResponse) # Changed to POST, more appropriate for actions
+async def generate_image_endpoint(req: GenerateRequest):
+    prompt, negative_prompt, aspect_ratio_key = req.prompt, req.negative_prompt, req.aspect_ratio_key
 
     image_width, image_height = ASPECT_RATIOS[aspect_ratio_key]
-    
-    # Generate a unique filename for the image
-    unique_id = uuid.uuid4() # Generates a random unique ID
-    output_filename = f"generated_image_{unique_id}.png"
 
-    print(f"\nReceived request to generate image:")
-    print(f"  Prompt: '{prompt}'")
-    if negative_prompt:
-        print(f"  Negative Prompt: '{negative_prompt}'")
-    print(f"  Aspect Ratio: {aspect_ratio_key} ({image_width}x{image_height})")
-    print(f"  Output Filename: {output_filename}")
+    cache_path = _cache_path(prompt, negative_prompt, aspect_ratio_key)
+    if await aiofiles.os.path.exists(cache_path):
+        logger.info(f"Serving cached image {cache_path} for prompt '{prompt}'")
+        async with aiofiles.open(cache_path, "rb") as f:
+            cached_image = await f.read()
+        return _images_response([cached_image], os.path.basename(cache_path))
 
-    try:
-        answers = stability_api.generate(
-            prompt=[
-                generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=1.0)),
-                generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0))
-            ] if negative_prompt else prompt,
-            steps=50,
-            cfg_scale=7.0,
-            width=image_width,
-            height=image_height,
-            samples=1,
-            sampler=generation.SAMPLER_K_DPMPP_2M
-        )
+    # Identical requests that arrive while a generation is running (or its
+    # image is still being cached) wait for that generation instead of paying
+    # for a second one.
+    generation_task = _inflight.get(cache_path)
+    if generation_task is None:
+        # Generate a unique filename for the image
+        output_filename = _new_output_filename()
+        filename = os.path.basename(output_filename)
 
-        image_saved_successfully = False
-        safety_filter_triggered = False
-        error_message = "No image generated."
+        logger.info(
+            f"Received request to generate image: prompt='{prompt}', negative_prompt='{negative_prompt}', "
+            f"aspect_ratio={aspect_ratio_key.value} ({image_width}x{image_height}), output={output_filename}"
+        )
 
-        for resp in answers:
-            for artifact in resp.artifacts:
-                if artifact.finish_reason == generation.FILTER:
-                    warnings.warn("Request activated the API's safety filter.")
-                    error_message = "Safety filter activated. Please modify prompt."
-                    safety_filter_triggered = True
-                    break
-                if artifact.type == generation.ARTIFACT_IMAGE:
-                    img = Image.open(io.BytesIO(artifact.binary))
-                    img.save(output_filename)
-                    print(f"Image successfully saved as {output_filename}")
-                    image_saved_successfully = True
-                    break
-            if image_saved_successfully or safety_filter_triggered:
-                break
-        
-        if image_saved_successfully:
-            return {
-                "message": "Image generated successfully!",
-                "filename": output_filename,
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "aspect_ratio": aspect_ratio_key
-            }
-        else:
-            return {"error": error_message, "details": "Could not generate or save image."}
+        generation_task = asyncio.create_task(
+            _generate(next(_next_stub), prompt, negative_prompt, aspect_ratio_key, output_filename, cache_path)
+        )
+        _inflight[cache_path] = generation_task
+        # Keep a reference even after _inflight drops it, in case every client leaves
+        _background_tasks.add(generation_task)
+        generation_task.add_done_callback(_background_tasks.discard)
+    else:
+        logger.info(f"Waiting for in-flight generation of prompt '{prompt}'")
+        filename = os.path.basename(cache_path)
 
-    except Exception as e:
-        print(f"Error during image generation: {e}")
-        return {"error": "Failed to generate image.", "details": str(e)}
\ No newline at end of file
+    # Shielded so this client disconnecting doesn't cancel the shared generation
+    result = await asyncio.shield(generation_task)
+    if isinstance(result, dict):
+        return result # Error response
+    return _images_response(result, filename)